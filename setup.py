@@ -6,6 +6,7 @@ from setup_utils import *
 
 shared_libs = []
 native_exes = []
+header_pairs = []
 ext_modules = []
 executables = []
 setup_kwarg = {}
@@ -244,8 +245,8 @@ if 'clean' in sys.argv:
     except Exception as e: print e
     """
 else:
-    headerize_multi_line('external/SDL2/GameControllerData', # button data
-                                    'gamecontrollerdb.txt', 'mapping.inl')
+    header_pairs.append(('external/SDL2/GameControllerData', # button data
+                            'gamecontrollerdb.txt', 'mapping.inl', True))
 
 # ==============================================================================
 # ~ [ mash3D ]
@@ -388,6 +389,7 @@ except ImportError:
 setup(
     shared_libs = shared_libs,
     native_exes = native_exes,
+    header_pairs = header_pairs,
     ext_modules = ext_modules,
     executables = executables,
 
@@ -5,7 +5,6 @@
 # TODOS:
 #  - allow setup.py to apply global attributes/config to all extensions and libs
 #  - give build_shared some options (use shared_lib.debug instead of __debug__)
-#  - only rebuild shared libs & EXEs if sources are modified (check timestamps)
 #  - NativeExecutable option to dynamically link the CRT or copy the dynamic lib
 #  - bundle debug libraries (python27_d.dll etc) with cx_freeze EXE on win32 dbg
 #  - disable C++ exception handling, iterator debugging, and RTTI on all builds
@@ -13,18 +12,33 @@
 # ------------------------------------------------------------------------------
 from __future__ import print_function
 
+import distutils.command.build
 import distutils.command.clean
 import distutils.ccompiler
+import distutils.sysconfig
+import distutils.core
+import distutils.dist
 import distutils
 
 import Cython.Compiler.Options
 import Cython.Distutils
+import Cython.Build
 
-import cx_Freeze
+# NOTE: cx_Freeze is slow to import, so it's only imported when it's actually used
+
+from multiprocessing.pool import ThreadPool
+from multiprocessing import cpu_count
 
 from glob import glob
+import collections
+import subprocess
+import functools
+import fnmatch
+import hashlib
+import errno
+import json
+import threading
 import shutil
-import copy
 import time
 import sys
 import os
@@ -34,14 +48,9 @@ import os
 # ==============================================================================
 
 if sys.version_info.major > 2 and sys.platform != 'win32':
-    #
-    # FIXME: in headerize, python is ignoring everything after the literal "\n"
-    #
-    if 0:
-        def WindowsLineEndingsFile(name, mode='r'):
-            return open(name, mode, newline='\r\n')
-    else:
-        WindowsLineEndingsFile = open
+    # only translate on write - reading with newline='\r\n' doesn't split on "\n"
+    def WindowsLineEndingsFile(name, mode='r'):
+        return open(name, mode, newline='\r\n' if 'w' in mode else None)
 
 elif sys.platform != 'win32':
     class WindowsLineEndingsFile(file):
@@ -51,41 +60,530 @@ elif sys.platform != 'win32':
 else:
     WindowsLineEndingsFile = open
 
-def headerize(path, src, dst, verbose=True):
+def _parallel_map(function, items):
+    """Call function on every item with a thread per core, and return the results.
+    Exceptions are re-raised, so this can be a drop-in replacement for a loop."""
+    if len(items) < 2: return [function(item) for item in items]
+
+    pool = ThreadPool(min(cpu_count(), len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def write_if_changed(name, text):
+    """Write a generated file, unless it already has the exact same contents. This
+    keeps the timestamp intact, so anything that #includes it isn't rebuilt."""
+    if os.path.exists(name):
+        with open(name, 'r') as f: # ignore CRLF line ending differences
+            if f.read().replace('\r\n', '\n') == text: return False
+
+    with WindowsLineEndingsFile(name, 'w') as f:
+        f.write(text)
+
+    return True
+
+# timestamps of when each generated header was last compared with its textfile. an
+# unchanged header isn't rewritten (so code including it isn't rebuilt), which means
+# its own timestamp can't tell us that a touched textfile was already checked.
+HEADERIZE_STAMP_DIR = os.path.join('build', 'headerize')
+
+def _headerize_stamp(dst_name):
+    """Get the path of the file that records when a header was last checked."""
+    name = _new_hash(os.path.normpath(dst_name).encode()).hexdigest()
+    return os.path.join(HEADERIZE_STAMP_DIR, name + '.stamp')
+
+def _header_is_current(src_name, dst_name):
+    """Check if a header was generated (or checked) after its textfile changed."""
+    if not os.path.exists(dst_name): return False
+
+    return not (_needs_rebuild(src_name, dst_name) and
+                _needs_rebuild(src_name, _headerize_stamp(dst_name)))
+
+def _mark_header_checked(dst_name):
+    """Record that a header matches its textfile, by updating its stamp file."""
+    if not os.path.isdir(HEADERIZE_STAMP_DIR): os.makedirs(HEADERIZE_STAMP_DIR)
+    open(_headerize_stamp(dst_name), 'w').close()
+
+def headerize(path, src, dst, verbose=True, force=False):
     """Convert textfiles to string literals that can be #included in C code."""
-    src_file = WindowsLineEndingsFile(os.path.join(path, src), 'r')
-    dst_file = WindowsLineEndingsFile(os.path.join(path, dst), 'w')
+    src_name = os.path.join(path, src)
+    dst_name = os.path.join(path, dst)
 
-    # TODO: make this (along with headerize_binary) a full-fledged distutils
-    # command that runs before any C code is generated, compiled, or linked.
+    # don't even read the textfile if the header was generated after it changed
+    if not force and _header_is_current(src_name, dst_name): return
 
-    if verbose: print('writing textfile "{}" to header "{}"' \
-                        .format(src_file.name, dst_file.name))
+    with open(src_name, 'r') as src_file:
+        lines = src_file.read().splitlines()
 
-    dst_file.write('// This file is automatically generated. Do not edit!\n\n')
+    text = ''.join(['// This file is automatically generated. Do not edit!\n\n'] +
+                ['"{}\\n"\n'.format(line.strip()) for line in lines] + [';\n'])
 
-    for line in src_file:
-        dst_file.write('"{}\\n"\n'.format(line.strip()))
+    if write_if_changed(dst_name, text) and verbose:
+        print('writing textfile "{}" to header "{}"'.format(src_name, dst_name))
 
-    dst_file.write(';\n')
+    _mark_header_checked(dst_name)
 
-def headerize_multi_line(path, src, dst, verbose=True):
+def headerize_multi_line(path, src, dst, verbose=True, force=False):
     """Hack for MSVC's super obnoxious 65535-character string literal limit."""
-    src_file = WindowsLineEndingsFile(os.path.join(path, src), 'r')
-    dst_file = WindowsLineEndingsFile(os.path.join(path, dst), 'w')
+    src_name = os.path.join(path, src)
+    dst_name = os.path.join(path, dst)
+
+    # don't even read the textfile if the header was generated after it changed
+    if not force and _header_is_current(src_name, dst_name): return
+
+    with open(src_name, 'r') as src_file:
+        lines = src_file.read().splitlines()
+
+    text = ''.join(['// This file is automatically generated. Do not edit!\n\n'] +
+                ['"{}\\n",\n'.format(line.strip()) for line in lines] + ['NULL,\n'])
+
+    if write_if_changed(dst_name, text) and verbose:
+        print('writing textfile "{}" to multi-line header "{}"' \
+                                        .format(src_name, dst_name))
+
+    _mark_header_checked(dst_name)
+
+def find_files(pattern):
+    """Recursively glob the current directory, skipping hidden dirs (like .git) and
+    build dirs that clean is deleting in the background (they can be very large)."""
+    matches = []
+
+    for dirpath, dirnames, filenames in os.walk('.'):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.') and
+                                            not name.startswith('build.trash.')]
+
+        for name in fnmatch.filter(dirnames + filenames, pattern):
+            matches.append(os.path.normpath(os.path.join(dirpath, name)))
+
+    return matches
+
+def remove_file(name):
+    """Delete a file, unless it's already gone (don't fail if something beat us)."""
+    try:
+        os.remove(name)
+    except OSError as e:
+        if e.errno != errno.ENOENT: raise
+
+# ===== [ incremental builds ] =================================================
+
+def _depfile(compiler, src, obj):
+    """Get the path of the header dependency file the compiler writes for obj.
+    GCC & clang write makefile rules (-MMD), and MSVC writes JSON, but only into
+    a directory (/sourceDependencies dir), where it's named after the source."""
+    if compiler.compiler_type == 'msvc':
+        return os.path.join(os.path.dirname(obj), os.path.basename(src) + '.json')
+
+    return os.path.splitext(obj)[0] + '.d'
+
+def _read_depfile(path):
+    """Get the list of files (source and headers) from a dependency file."""
+    with open(path) as depfile:
+        text = depfile.read()
+
+    if text.startswith('{'): # msvc 16.10 and up
+        data = json.loads(text)['Data']
+        return [data['Source']] + data['Includes']
+
+    text = text.replace('\\\n', ' ') # makefile line continuations
+    return text.partition(': ')[2].split() # skip "target: " (windows has "C:\")
+
+def _object_dir(kind, ext):
+    """Get the directory that keeps an extension's objects around between builds.
+    Debug and release objects are kept separately, as they use different flags."""
+    return os.path.join('build', kind + '_objs',
+                        ext.name + ('_d' if __debug__ else ''))
+
+def _needs_rebuild(src, obj, extra_deps=(), depfile=None):
+    """Check if an object file is missing, or older than any of its dependencies.
+    If the compiler wrote a depfile for the object, included headers are checked."""
+    if not os.path.exists(obj): return True
+
+    obj_mtime = os.path.getmtime(obj)
+
+    deps = [src] + list(extra_deps)
+
+    if depfile and os.path.exists(depfile):
+        deps.extend(_read_depfile(depfile))
+
+    for dep in deps: # treat missing deps as always modified
+        if not os.path.exists(dep) or os.path.getmtime(dep) >= obj_mtime:
+            return True
+
+    return False
+
+# ===== [ object cache ] =======================================================
+
+# objects are stored by the hash of their inputs, so switching git branches (which
+# resets file timestamps) doesn't force a full rebuild. set AXLE_NO_OBJCACHE=1 to
+# disable the cache. it's only used when the compiler wrote depfiles for objects.
+OBJECT_CACHE_DIR = os.path.join('build', 'objcache')
+
+# python 2 doesn't have blake2, but any hash function works for our purposes here
+try:
+    _new_hash = functools.partial(hashlib.blake2b, digest_size=20) # short paths
+except AttributeError:
+    _new_hash = hashlib.sha1
+
+def _compiler_version(compiler):
+    """Identify the compiler executable, flags, and version for object cache keys."""
+    try:
+        return compiler._axle_version
+    except AttributeError:
+        pass
+
+    if not getattr(compiler, 'initialized', True):
+        compiler.initialize() # msvc finds cl.exe lazily
+
+    command = (getattr(compiler, 'compiler_so', None) or
+                [getattr(compiler, 'cc', compiler.compiler_type)])
+
+    try:
+        output = subprocess.check_output(command[:1] + ['--version'],
+                                            stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        output = e.output # cl.exe prints its banner, then rejects --version
+    except OSError:
+        output = b''
+
+    compiler._axle_version = repr(command).encode() + output
+    return compiler._axle_version
+
+def _cache_key(flags_key, src):
+    """Hash the path and contents of a source file with its compiler flags' hash.
+    The same source in another directory can include different headers (#include
+    "..." is relative), and has a different __FILE__ and debug info."""
+    digest = _new_hash(flags_key.encode())
+    digest.update(os.path.normcase(os.path.normpath(src)).encode())
+
+    with open(src, 'rb') as f: digest.update(f.read())
+
+    return digest.hexdigest()
+
+def _cached_object(compiler, key):
+    """Get the object path for a cache key, or None if we don't know its headers.
+    The header list from the last build of the key is hashed into the path, so
+    editing any included file results in a cache miss (like ccache's manifests)."""
+    depfile = os.path.join(OBJECT_CACHE_DIR, key + '.d')
+    if not os.path.exists(depfile): return None
+
+    digest = _new_hash(key.encode())
+
+    for dep in _read_depfile(depfile):
+        if not os.path.exists(dep): return None
+        with open(dep, 'rb') as f: digest.update(f.read())
+
+    return os.path.join(OBJECT_CACHE_DIR, digest.hexdigest() + compiler.obj_extension)
+
+# ===== [ compilation ] ========================================================
+
+def _parallel_compile(self, sources, output_dir=None, macros=None,
+                    include_dirs=None, debug=0, extra_preargs=None,
+                    extra_postargs=None, depends=None):
+    """Replacement for CCompiler.compile that runs a compiler process per core.
+    The GIL is released while we wait on each process, so threads are fine."""
+    macros, objects, extra_postargs, pp_opts, build = self._setup_compile(
+            output_dir, macros, include_dirs, sources, depends, extra_postargs)
+
+    cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
+
+    def compile_object(obj):
+        try:
+            src, ext = build[obj]
+        except KeyError:
+            return
+
+        self._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+
+    _parallel_map(compile_object, objects) # re-raises the first CompileError
+
+    # Return *all* object filenames, not just the ones we just built.
+    return objects
+
+# msvc overrides compile entirely (it has its own /MP switch), so this only affects
+# unix compilers. check the flag so we don't patch twice if we're reloaded or such.
+if not getattr(distutils.ccompiler.CCompiler, '_axle_parallel', False):
+    distutils.ccompiler.CCompiler.compile = _parallel_compile
+    distutils.ccompiler.CCompiler._axle_parallel = True
+
+def _compile_flags(compiler, ext):
+    """Get the macros and extra args to compile an extension with, and a hash of
+    them (and the compiler), which is stored with its objects to detect changes."""
+    macros = ext.define_macros[:] # build (un-)defines list
+    for undef in ext.undef_macros: macros.append((undef,))
+
+    extra_args = ext.extra_compile_args or []
+
+    digest = _new_hash(_compiler_version(compiler))
+
+    for value in [macros, ext.include_dirs, extra_args, __debug__]:
+        digest.update(repr(value).encode())
+
+    return macros, extra_args, digest.hexdigest()
+
+def _flags_stamp(output_dir):
+    """Get the path of the file holding the flags hash of the objects in a dir."""
+    return os.path.join(output_dir, 'flags.key')
+
+def _stale_sources(compiler, ext, output_dir, flags_key):
+    """Get the sources of an extension that need compiling into output_dir, because
+    they (or their headers) changed, or the extension's compiler flags changed."""
+    try:
+        with open(_flags_stamp(output_dir)) as f: same_flags = f.read() == flags_key
+    except IOError:
+        same_flags = False
+
+    objects = compiler.object_filenames(ext.sources, output_dir=output_dir)
+
+    return [src for src, obj in zip(ext.sources, objects) if not same_flags or
+            _needs_rebuild(src, obj, ext.depends, _depfile(compiler, src, obj))]
+
+def compile_objects(compiler, ext, output_dir, force=False):
+    """Compile the modified sources of an extension, and return all of its objects.
+    Objects are kept in output_dir between runs, so we can skip unchanged sources."""
+    macros, extra_args, flags_key = _compile_flags(compiler, ext)
+
+    use_cache = not (compiler.dry_run or os.environ.get('AXLE_NO_OBJCACHE'))
+
+    # map every source to the object it will produce, even if we don't build it
+    objects = compiler.object_filenames(ext.sources, output_dir=output_dir)
+
+    stale = list(ext.sources) if force else \
+            _stale_sources(compiler, ext, output_dir, flags_key)
+
+    keys = {}
+
+    if use_cache:
+        compiler.mkpath(OBJECT_CACHE_DIR)
+
+        for src, obj in zip(ext.sources, objects):
+            if src not in stale: continue
+
+            keys[src] = key = _cache_key(flags_key, src)
+            if force: continue # still update the cache, but don't read from it
+
+            cached_obj = _cached_object(compiler, key)
+
+            if cached_obj and os.path.exists(cached_obj):
+                compiler.announce('using cached object for {}'.format(src), 2)
+
+                if not os.path.isdir(os.path.dirname(obj)):
+                    os.makedirs(os.path.dirname(obj))
+
+                shutil.copyfile(cached_obj, obj)
+                shutil.copyfile(os.path.join(OBJECT_CACHE_DIR, key + '.d'),
+                                            _depfile(compiler, src, obj))
+                stale.remove(src)
+
+    if stale and compiler.compiler_type == 'msvc':
+        # cl.exe writes depfiles into a directory, named after their source files.
+        # sources with the same name could clash, so build a directory at a time.
+        # older versions of msvc just warn about the unknown option and carry on.
+        obj_dirs = collections.OrderedDict()
+
+        for src, obj in zip(ext.sources, objects):
+            if src in stale: obj_dirs.setdefault(os.path.dirname(obj), []).append(src)
+
+        for obj_dir, sources in obj_dirs.items():
+            compiler.compile(sources, output_dir=output_dir, macros=macros,
+                    include_dirs=ext.include_dirs, debug=__debug__,
+                    extra_postargs=extra_args + ['/sourceDependencies', obj_dir])
+
+    elif stale:
+        compiler.compile(stale, output_dir=output_dir, macros=macros,
+                include_dirs=ext.include_dirs, debug=__debug__,
+                extra_postargs=extra_args)
+
+    for src, obj in zip(ext.sources, objects):
+        if src not in stale or src not in keys: continue
+
+        depfile = _depfile(compiler, src, obj)
+        if not os.path.exists(depfile): continue
+
+        shutil.copyfile(depfile, os.path.join(OBJECT_CACHE_DIR, keys[src] + '.d'))
+        shutil.copyfile(obj, _cached_object(compiler, keys[src]))
+
+    # only record the flags once every object is built with them (errors raise)
+    if stale and not compiler.dry_run:
+        with open(_flags_stamp(output_dir), 'w') as f: f.write(flags_key)
+
+    return objects
+
+def _any_stale(compiler, links, kind):
+    """Check if any shared libs or native exes (kind) need to be built, because any
+    sources, headers, compiler flags or link arguments changed since the last build.
+    links are the files the command would link (see _shared_links/_native_links)."""
+    manifest = _load_link_manifest()
+
+    for exts, output, target, link_args in links:
+        linked = manifest.get(target)
+
+        if not (os.path.exists(target) and isinstance(linked, dict) and
+                linked.get('args') == _link_args_key(output, link_args)):
+            return True
+
+        target_mtime = os.path.getmtime(target)
+
+        for ext in exts:
+            objects = compiler.object_filenames(ext.sources,
+                                    output_dir=_object_dir(kind, ext))
+
+            # debug and release builds use separate objects but share the same target,
+            # so check that the target was last linked from this build mode's objects.
+            if not set(objects) <= set(linked['objects']): return True
+
+            if _stale_sources(compiler, ext, _object_dir(kind, ext),
+                                _compile_flags(compiler, ext)[2]):
+                return True
+
+            for obj in objects: # not linked since changing
+                if os.path.getmtime(obj) > target_mtime: return True
+
+    return False
+
+# ===== [ linking ] ============================================================
+
+# the objects & arguments used for the last link of each output file, so we don't
+# rely on timestamps (distutils' check only has a resolution of a whole second).
+LINK_MANIFEST = os.path.join('build', 'manifest.json')
+
+def _link_args_key(output, link_args):
+    """Hash the arguments for a link (without the objects), to detect changes."""
+    return _new_hash(repr([output, sorted(link_args.items())]).encode()).hexdigest()
+
+def _link_key(objects, output, link_args):
+    """Hash the contents of the objects to link, along with the linker arguments."""
+    digest = _new_hash(repr([objects, _link_args_key(output, link_args)]).encode())
+
+    for obj in objects:
+        with open(obj, 'rb') as f: digest.update(_new_hash(f.read()).digest())
+
+    return digest.hexdigest()
+
+def _load_link_manifest():
+    """Get the targets linked by previous builds, with their keys and objects."""
+    try:
+        with open(LINK_MANIFEST) as f: return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def link_objects(compiler, link, objects, output, target=None, force=False,
+                                                                **link_args):
+    """Call a compiler link method, unless nothing changed since the last link.
+    target is the path of the file produced, if it isn't the output argument."""
+    target = target or output
+
+    manifest = _load_link_manifest()
+    linked = manifest.get(target)
+
+    key = None if compiler.dry_run else _link_key(objects, output, link_args)
+
+    if not force and os.path.exists(target) and isinstance(linked, dict) \
+                                            and linked['key'] == key:
+        compiler.announce('skipping {} (up-to-date)'.format(target), 2)
 
-    # TODO: make this (along with headerize(_binary)) a full-fledged distutils
-    # command that runs before any C code is generated, compiled, or linked.
+        # objects may have been rebuilt (or copied from the cache) with the same
+        # contents, so keep the target newer than them for the checks in build.
+        os.utime(target, None)
+        return
 
-    if verbose: print('writing textfile "{}" to multi-line header "{}"' \
-                                    .format(src_file.name, dst_file.name))
+    # if objects changed in the same second as the last link, distutils' check
+    # would skip the link, so just remove the old file to force it to happen.
+    if os.path.exists(target) and not compiler.dry_run: os.remove(target)
 
-    dst_file.write('// This file is automatically generated. Do not edit!\n\n')
+    link(objects, output, **link_args)
 
-    for line in src_file:
-        dst_file.write('"{}\\n",\n'.format(line.strip()))
+    if not compiler.dry_run:
+        manifest[target] = {'key': key, 'objects': objects,
+                            'args': _link_args_key(output, link_args)}
 
-    dst_file.write('NULL,\n')
+        with open(LINK_MANIFEST, 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+
+def _merge_lists(exts, attr):
+    """Combine a list of names or dirs from several extensions, removing duplicates."""
+    if len(exts) == 1: return getattr(exts[0], attr) or []
+    merged = []
+
+    for ext in exts:
+        for value in getattr(ext, attr) or []:
+            if value not in merged: merged.append(value)
+
+    return merged
+
+def _merge_link_args(exts):
+    """Concatenate the link args of several extensions. Args can come in pairs (like
+    -framework Cocoa), so only whole lists that are identical are deduplicated."""
+    if len(exts) == 1: return exts[0].extra_link_args or []
+    merged, seen = [], []
+
+    for ext in exts:
+        args = ext.extra_link_args or []
+
+        if args not in seen:
+            seen.append(args)
+            merged.extend(args)
+
+    return merged
+
+def _shared_links(compiler, shared_libs):
+    """Get a (libs, output, target, link_args) tuple for each file that build_shared
+    links. Libs in the same group are linked together, and others are separate."""
+    groups = collections.OrderedDict()
+
+    for shared_lib in shared_libs:
+        shared_lib.apply_global_config() # apply our global attributes
+
+        key = shared_lib.group or id(shared_lib) # ungrouped libs are separate
+        groups.setdefault(key, []).append(shared_lib)
+
+    links = []
+
+    for libs in groups.values():
+        output = compiler.library_filename(libs[0].group or libs[0].name, 'shared')
+        languages = [lib._language(compiler) for lib in libs] # detect language
+
+        links.append((libs, output, output, dict(
+            libraries=_merge_lists(libs, 'libraries'),
+            library_dirs=_merge_lists(libs, 'library_dirs'),
+            runtime_library_dirs=_merge_lists(libs, 'runtime_library_dirs'),
+            extra_postargs=_merge_link_args(libs),
+            debug=__debug__,
+            target_lang='c++' if 'c++' in languages else languages[0])))
+
+    return links
+
+def _native_links(compiler, native_exes):
+    """Get a (exes, output, target, link_args) tuple for each native executable."""
+    links = []
+
+    for native_exe in native_exes:
+        native_exe.apply_global_config() # apply our global attributes
+
+        # we want to specify non-console mode by default on windows apps
+        # XXX: there is probably a more elegant place to shoehorn this.
+        # also note that this requires the use of WinMain on win32 apps!
+        extra_link_args = list(native_exe.extra_link_args or [])
+
+        if sys.platform == 'win32':
+            try:
+                s = native_exe.windows_subsystem.upper()
+            except AttributeError:
+                s = 'CONSOLE' if __debug__ else 'WINDOWS'
+
+            extra_link_args.append('/SUBSYSTEM:{}'.format(s))
+
+        links.append(([native_exe], native_exe.name,
+            compiler.executable_filename(native_exe.name), dict(
+            libraries=native_exe.libraries,
+            library_dirs=native_exe.library_dirs,
+            runtime_library_dirs=native_exe.runtime_library_dirs,
+            extra_postargs=extra_link_args,
+            debug=__debug__,
+            target_lang=native_exe._language(compiler)))) # detect language
+
+    return links
 
 # ==============================================================================
 # ~ [ cython configuration ]
@@ -125,6 +623,10 @@ cython_directive_defaults['infer_types'] = True
 cython_directive_defaults['autotestdict'] = __debug__
 cython_directive_defaults['unraisable_tracebacks'] = __debug__
 
+# build the final directives once. build_ext merges each extension's own directives
+# over these and attaches the result to it, so cythonize gets one complete dict.
+cython_directives = dict(cython_directive_defaults)
+
 # ==============================================================================
 # ~ [ info containers ]
 # ==============================================================================
@@ -134,6 +636,7 @@ class Distribution(distutils.dist.Distribution):
         self.executables = [] # cached by the constructor
         self.shared_libs = [] # shared libraries to build
         self.native_exes = [] # native C(++) applications
+        self.header_pairs = [] # (path, src, dst[, multi_line]) textfiles
 
         distutils.dist.Distribution.__init__(self, attrs)
 
@@ -141,6 +644,9 @@ class Extension(Cython.Distutils.Extension):
     def apply_global_config(self):
         """Add compiler flags, macros, etc. that we want applied to all extensions. We
         assume that non-Windows platforms are Unix & have GCC-compatible compilers."""
+        if getattr(self, '_axle_configured', False):
+            return self # don't keep appending the same flags if we're run twice
+
         if sys.platform == 'win32':
             # silence bogus warnings about c standard library functions like sprintf
             self.define_macros.append(('_CRT_SECURE_NO_WARNINGS', '1'))
@@ -159,6 +665,11 @@ class Extension(Cython.Distutils.Extension):
             self.extra_compile_args.append('/wd4334') # 32-bit shift
             self.extra_compile_args.append('/wd4985') # type annotations
 
+            # compile multiple sources in parallel, when they're passed to cl.exe at once
+            # (unless the user already has it in their CL environment variable).
+            if '/MP' not in os.environ.get('CL', '').upper():
+                self.extra_compile_args.append('/MP')
+
             # more recent versions of cython export multiple module init functions
             self.extra_link_args.append('/ignore:4197')
         else:
@@ -185,6 +696,13 @@ class Extension(Cython.Distutils.Extension):
 
             self.extra_link_args.append('-Wno-unused-command-line-argument')
 
+            # use pipes instead of temporary files between stages of the compilation
+            self.extra_compile_args.append('-pipe')
+
+            # write the headers each object includes to a depfile next to it, so
+            # we know what to rebuild when a header changes (see compile_objects)
+            self.extra_compile_args.append('-MMD')
+
         # for whatever reason, distutils' unixccompiler doesn't have a different set of
         # debug arguments like in win32. XXX TODO -g is still passed in release builds.
         if sys.platform != 'win32' and __debug__:
@@ -201,10 +719,27 @@ class Extension(Cython.Distutils.Extension):
             # disable the runtime check for "__debug__" in release builds
             self.define_macros.append(('CYTHON_WITHOUT_ASSERTIONS', '1'))
 
+        self._axle_configured = True
         return self
 
+    def _language(self, compiler):
+        """Get the extension's language, detecting it from the sources only once."""
+        lang = getattr(self, '_lang_cache', None)
+
+        if lang is None:
+            lang = self.language or compiler.detect_language(self.sources)
+            self._lang_cache = lang
+
+        return lang
+
 class SharedLibrary(Extension):
-    pass
+    def __init__(self, *args, **kwargs):
+        # libs in the same group are linked into one file, named after the group.
+        # this saves a linker run per lib (extensions must link to the group name).
+        # it's not passed on, as distutils warns about unknown extension options.
+        self.group = kwargs.pop('group', None)
+
+        Extension.__init__(self, *args, **kwargs) # can't super()
 
 class NativeExecutable(Extension):
     def __init__(self, *args, **kwargs):
@@ -213,162 +748,278 @@ class NativeExecutable(Extension):
         if 'windows_subsystem' in kwargs: # windows, or console
             self.windows_subsystem = kwargs['windows_subsystem']
 
-class Executable(cx_Freeze.Executable):
-    pass
+def Executable(*args, **kwargs):
+    """Create a cx_Freeze executable (without importing cx_Freeze up front)."""
+    import cx_Freeze
+    return cx_Freeze.Executable(*args, **kwargs)
 
 # ==============================================================================
 # ~ [ commands ]
 # ==============================================================================
 
-class build_shared(distutils.core.Command):
-    user_options = [] # TODO: populate with options (see TODO list above)
+def _get_compiler(command):
+    """Create the compiler for build_shared and build_native, and share it between
+    them (so sysconfig is only parsed once). build_ext modifies its own compiler's
+    include dirs, libraries & macros, so it still has to make a separate one."""
+    compiler = getattr(command.distribution, '_axle_compiler', None)
+
+    if compiler is None:
+        compiler = distutils.ccompiler.new_compiler(verbose=command.verbose,
+                                dry_run=command.dry_run, force=command.force)
+
+        # apply platform-specific configuration from environment variables
+        distutils.sysconfig.customize_compiler(compiler)
+
+        command.distribution._axle_compiler = compiler
+
+    return compiler
+
+class build_headerize(distutils.core.Command):
+    user_options = [
+        ('force', 'f', "forcibly build everything (ignore file timestamps)"),
+    ]
+
+    boolean_options = ['force']
 
     def initialize_options(self):
-        pass
+        self.force = None
 
     def finalize_options(self):
-        pass
+        self.set_undefined_options('build', ('force', 'force'))
 
     def run(self):
-        compiler = distutils.ccompiler.new_compiler(verbose=self.verbose,
-                                dry_run=self.dry_run, force=self.force)
+        def run_pair(pair):
+            path, src, dst = pair[:3]
 
-        # apply platform-specific configuration from environment variables
-        distutils.sysconfig.customize_compiler(compiler)
+            # use the multi-line version for big files, if MSVC has to compile them
+            function = headerize_multi_line if pair[3:] and pair[3] else headerize
+            function(path, src, dst, verbose=self.verbose, force=self.force)
+
+        _parallel_map(run_pair, self.distribution.header_pairs)
+
+class build_shared(distutils.core.Command):
+    user_options = [ # TODO: populate with options (see TODO list above)
+        ('force', 'f', "forcibly build everything (ignore file timestamps)"),
+    ]
+
+    boolean_options = ['force']
 
-        for shared_lib in self.distribution.shared_libs:
-            shared_lib.apply_global_config() # apply our global attributes
+    def initialize_options(self):
+        self.force = None
+
+    def finalize_options(self):
+        self.set_undefined_options('build', ('force', 'force'))
 
-            macros = shared_lib.define_macros[:] # build (un-)defines list
-            for undef in shared_lib.undef_macros: macros.append((undef,))
+    def run(self):
+        # generate any headers from text files before compiling code that uses them
+        if self.distribution.header_pairs: self.run_command('build_headerize')
 
-            language = (shared_lib.language or # detect required language
-                            compiler.detect_language(shared_lib.sources))
+        compiler = _get_compiler(self)
 
-            objects = compiler.compile(shared_lib.sources, macros=macros,
-                    include_dirs=shared_lib.include_dirs, debug=__debug__,
-                    extra_postargs=shared_lib.extra_compile_args or [])
+        for shared_libs, output, target, link_args in _shared_links(compiler,
+                                                self.distribution.shared_libs):
+            objects = []
 
-            compiler.link_shared_object(
-                objects,
-                compiler.library_filename(shared_lib.name, 'shared'),
-                libraries=shared_lib.libraries,
-                library_dirs=shared_lib.library_dirs,
-                runtime_library_dirs=shared_lib.runtime_library_dirs,
-                extra_postargs=shared_lib.extra_link_args or [],
-                debug=__debug__,
-                target_lang=language)
+            for shared_lib in shared_libs:
+                objects.extend(compile_objects(compiler, shared_lib,
+                            _object_dir('shared', shared_lib), self.force))
 
-            for obj in objects: os.remove(obj)
+            link_objects(compiler, compiler.link_shared_object, objects, output,
+                                    target, force=self.force, **link_args)
 
 class build_native(distutils.core.Command):
-    user_options = [] # TODO: populate with options (see TODO list above)
+    user_options = [ # TODO: populate with options (see TODO list above)
+        ('force', 'f', "forcibly build everything (ignore file timestamps)"),
+    ]
+
+    boolean_options = ['force']
 
     def initialize_options(self):
-        pass
+        self.force = None
 
     def finalize_options(self):
-        pass
+        self.set_undefined_options('build', ('force', 'force'))
 
     def run(self):
-        # TODO: common path! this is mostly copied + pasted from shared lib
-        compiler = distutils.ccompiler.new_compiler(verbose=self.verbose,
-                                dry_run=self.dry_run, force=self.force)
+        # generate any headers from text files before compiling code that uses them
+        if self.distribution.header_pairs: self.run_command('build_headerize')
 
-        # apply platform-specific configuration from environment variables
-        distutils.sysconfig.customize_compiler(compiler)
+        compiler = _get_compiler(self)
+
+        for native_exes, output, target, link_args in _native_links(compiler,
+                                                self.distribution.native_exes):
+            objects = compile_objects(compiler, native_exes[0],
+                        _object_dir('native', native_exes[0]), self.force)
 
-        for native_exe in self.distribution.native_exes:
-            native_exe.apply_global_config() # apply our global attributes
+            link_objects(compiler, compiler.link_executable, objects, output,
+                                    target, force=self.force, **link_args)
 
-            macros = native_exe.define_macros[:] # build (un-)defines list
-            for undef in native_exe.undef_macros: macros.append((undef,))
+class build_ext(Cython.Distutils.build_ext):
+    def run(self):
+        # generate any headers from text files before compiling code that uses them
+        if self.distribution.header_pairs: self.run_command('build_headerize')
 
-            language = (native_exe.language or # detect required language
-                            compiler.detect_language(native_exe.sources))
+        Cython.Distutils.build_ext.run(self)
 
-            objects = compiler.compile(native_exe.sources, macros=macros,
-                    include_dirs=native_exe.include_dirs, debug=__debug__,
-                    extra_postargs=native_exe.extra_compile_args or [])
+    def build_extensions(self):
+        # transpile every cython module up front, using a process per core. spawning
+        # processes on windows would require a __main__ guard in setup.py, so don't.
+        cython_exts = [ext for ext in self.extensions
+                        if any(s.endswith('.pyx') for s in ext.sources)]
 
-            # we want to specify non-console mode by default on windows apps
-            # XXX: there is probably a more elegant place to shoehorn this.
-            # also note that this requires the use of WinMain on win32 apps!
-            if native_exe.extra_link_args is None:
-                native_exe.extra_link_args = []
+        if cython_exts:
+            nthreads = 0 if sys.platform == 'win32' else cpu_count()
 
-            if sys.platform == 'win32':
-                try:
-                    s = native_exe.windows_subsystem.upper()
-                except AttributeError:
-                    s = 'CONSOLE' if __debug__ else 'WINDOWS'
+            # cythonize drops per-extension cython attributes from the extensions it
+            # creates, so each set of extensions with the same options is done apart
+            groups = collections.OrderedDict()
 
-                native_exe.extra_link_args.append('/SUBSYSTEM:{}'.format(s))
+            for ext in cython_exts:
+                options = self._cython_options(ext)
+                key = repr(sorted(options.items()))
 
-            compiler.link_executable(
-                objects,
-                native_exe.name,
-                libraries=native_exe.libraries,
-                library_dirs=native_exe.library_dirs,
-                runtime_library_dirs=native_exe.runtime_library_dirs,
-                extra_postargs=native_exe.extra_link_args,
-                debug=__debug__,
-                target_lang=language)
+                ext.cython_directives = options['compiler_directives']
 
-            for obj in objects: os.remove(obj)
+                groups.setdefault(key, (options, []))[1].append(ext)
+
+            cythonized = {}
+
+            for options, exts in groups.values():
+                for ext in Cython.Build.cythonize(exts, nthreads=nthreads,
+                                            force=self.force, **options):
+                    cythonized[ext.name] = ext
+
+            self.extensions = [cythonized.get(ext.name, ext) for ext in self.extensions]
+
+        Cython.Distutils.build_ext.build_extensions(self)
+
+    def _cython_options(self, ext):
+        """Get the cythonize options for an extension, combining the command's cython
+        options with the extension's own (like cython's old build_ext command did)."""
+        def flag(name):
+            return bool(getattr(self, name, None) or getattr(ext, name, None))
+
+        directives = dict(cython_directives) # global, then command, then extension
+        directives.update(getattr(self, 'cython_directives', None) or {})
+        directives.update(getattr(ext, 'cython_directives', None) or {})
+
+        include_path = list(getattr(self, 'cython_include_dirs', None) or [])
+
+        for path in (getattr(ext, 'cython_include_dirs', None) or []) + ext.include_dirs:
+            if path not in include_path: include_path.append(path)
+
+        options = {
+            'compiler_directives': directives,
+            'include_path': include_path,
+            'use_listing_file': flag('cython_create_listing'),
+            'emit_linenums': flag('cython_line_directives'),
+            'c_line_in_traceback': not flag('no_c_in_traceback'),
+            'generate_pxi': flag('cython_gen_pxi'),
+        }
+
+        compile_time_env = (getattr(ext, 'cython_compile_time_env', None) or
+                            getattr(self, 'cython_compile_time_env', None))
+
+        if compile_time_env: options['compile_time_env'] = compile_time_env
+
+        if flag('cython_c_in_temp'): options['build_dir'] = self.build_temp
+        if flag('cython_cplus'): options['language'] = 'c++'
+
+        if flag('cython_gdb'): # the debug info goes into the current directory
+            options['gdb_debug'] = True
+            options['output_dir'] = os.curdir
+
+        return options
 
-class build_ext(Cython.Distutils.build_ext):
     def build_extension(self, ext):
         Cython.Distutils.build_ext.build_extension(self, ext.apply_global_config())
 
-class build(cx_Freeze.build):
+class build(distutils.command.build.build): # cx_Freeze.build is mixed in by setup
     def get_sub_commands(self):
         # only build exes with the "build_exe" command (it can take a few seconds)
         commands = distutils.command.build.build.get_sub_commands(self)
 
+        # skip native code commands entirely if nothing changed since the last build.
+        # this is the same compiler they use, as flag changes have to be detected.
+        compiler = _get_compiler(self)
+
         # we want to build native executables after the shared libraries they use
-        if self.distribution.native_exes: commands.insert(0, 'build_native')
+        if self.distribution.native_exes and (self.force or _any_stale(compiler,
+                _native_links(compiler, self.distribution.native_exes), 'native')):
+            commands.insert(0, 'build_native')
 
         # we want to build shared libraries before the c extensions that use them
-        if self.distribution.shared_libs: commands.insert(0, 'build_shared')
+        if self.distribution.shared_libs and (self.force or _any_stale(compiler,
+                _shared_links(compiler, self.distribution.shared_libs), 'shared')):
+            commands.insert(0, 'build_shared')
 
         return commands
 
-class build_exe(cx_Freeze.build_exe):
-    pass
+    def run(self):
+        # generate headers before get_sub_commands checks if any code is out of date
+        if self.distribution.header_pairs: self.run_command('build_headerize')
+
+        distutils.command.build.build.run(self)
+
+def _remove_trees(paths):
+    """Delete a list of directories, ignoring errors (run on a background thread)."""
+    for path in paths: shutil.rmtree(path, ignore_errors=True)
 
 class clean(distutils.command.clean.clean):
     def run(self):
         # just toss the entire build directory, as cx_freeze doesn't clean up exes.
-        if os.path.exists('build'): shutil.rmtree('build')
-
-        # clean up files cython leaves behind - this applies to python 2 builds only.
+        # renaming it is instant, so it's deleted in the background while we clean
+        # everything else. this isn't a daemon thread, so python waits for it on
+        # exit (otherwise trash dirs would be left behind if we finish first).
+        if os.path.exists('build'):
+            try:
+                os.rename('build', 'build.trash.{}.{}'.format(os.getpid(),
+                                                int(time.time() * 1000)))
+            except OSError:
+                shutil.rmtree('build') # windows can't rename dirs with open files
+
+        # also remove any leftover trash from an interrupted clean
+        threading.Thread(target=_remove_trees, args=(glob('build.trash.*'),)).start()
+
+        # clean up files cython leaves behind. python 2 puts generated files next to
+        # the source, and python 3 builds the modules in each top-level package dir.
         # XXX TODO: the way these paths are handled is kinda hackish... clean it up!
+        ext_modules = self.distribution.ext_modules or []
 
-        for name in [ os.path.splitext( extension.sources[0] )[0] for extension in \
-                    self.distribution.ext_modules if '.py' in extension.sources[0]]:
-            for ext in ['.c', '.cpp', '.so', '.pyd', '.pdb']:
-                if os.path.exists(name + '_d' + ext): os.remove(name + '_d' + ext)
-                if os.path.exists(name + ext): os.remove(name + ext)
+        generated = set() # only list each directory once, even if it has many exts
+        package_dirs = set(ext.name.split('.')[0] for ext in ext_modules)
 
-        # clean up files cython leaves behind - this applies to python 3 builds only.
-        # XXX TODO: the way these paths are handled is kinda hackish... clean it up!
+        for ext in ext_modules:
+            if '.py' in ext.sources[0]:
+                name = os.path.splitext(ext.sources[0])[0]
+
+                for suffix in ['', '_d']:
+                    for file_ext in ['.c', '.cpp', '.so', '.pyd', '.pdb']:
+                        generated.add(os.path.normpath(name + suffix + file_ext))
+
+        generated_dirs = set(os.path.dirname(name) or '.' for name in generated)
+        removed = set()
+
+        for path in package_dirs | generated_dirs:
+            if not os.path.isdir(path): continue
 
-        for path in [extension.name.split('.')[0] for extension in \
-                                    self.distribution.ext_modules]:
             for name in os.listdir(path):
-                for ext in ['.so', '.pyd']:
-                    if name.endswith(ext): os.remove(os.path.join(path, name))
+                name = os.path.normpath(os.path.join(path, name))
+
+                if name in generated or (path in package_dirs and
+                                        name.endswith(('.so', '.pyd'))):
+                    removed.add(name)
+
+        _parallel_map(os.remove, sorted(removed))
 
         # clean up after build_shared. if you need libs that are deleted by this,
         # then you must copy them from some platform-specific path before build.
         if sys.platform == 'win32':
-            for name in [s for s in glob("*.dll") + glob("*.manifest") +
-                                    glob("*.pdb") + glob("*.exp") +
-                                    glob("*.lib") if "python" not in s]:
-                os.remove(name)
+            _parallel_map(os.remove, [s for s in glob("*.dll") + glob("*.manifest") +
+                                        glob("*.pdb") + glob("*.exp") +
+                                        glob("*.lib") if "python" not in s])
         else:
-            for name in glob("*.so"): os.remove(name)
+            _parallel_map(os.remove, glob("*.so"))
 
         # clean up after build_native. only windows programs have file extensions!
         for name in [exe.name for exe in self.distribution.native_exes]:
@@ -379,17 +1030,12 @@ class clean(distutils.command.clean.clean):
 
         # delete serialized python bytecode files throughout the entire source tree,
         # and clean up shared library build metadata left behind by visual studio.
-        for dirpath, dirnames, filenames in os.walk('.'):
+        # python 3 puts serialized bytecode files into a __pycache__ directory.
+        for path in find_files('__pycache__'): shutil.rmtree(path, ignore_errors=True)
 
-            # python 2 puts serialized bytecode files inline with package .py files.
-            for filename in filenames:
-                if (filename.endswith('.manifest') or
-                    filename.endswith('.pyc') or
-                    filename.endswith('.pyo') ):
-                    os.remove(os.path.join(dirpath, filename))
-
-            # python 3 puts serialized bytecode files into a __pycache__ directory.
-            if '__pycache__' in dirpath: shutil.rmtree(dirpath)
+        # python 2 puts serialized bytecode files inline with package .py files.
+        for pattern in ['*.pyc', '*.pyo', '*.manifest']:
+            for path in find_files(pattern): remove_file(path)
 
         distutils.command.clean.clean.run(self) # delete temporary build directories
 
@@ -397,26 +1043,42 @@ class clean(distutils.command.clean.clean):
 # ~ [ setup ]
 # ==============================================================================
 
+def _needs_freeze(args):
+    """Check if the command line uses any of cx_Freeze's commands or options."""
+    for arg in args:
+        arg = arg.split('=')[0]
+
+        if arg in ('build_exe', 'install', 'install_exe', '--build-exe'):
+            return True
+
+        if arg.startswith('bdist'): # msi, dmg, mac, etc.
+            return True
+
+    return False
+
 def setup(**options):
-    # don't pollute the user config with ours (in case they want to setup twice)
-    kwargs = copy.deepcopy(options)
+    # don't pollute the user config with ours (in case they want to setup twice).
+    # only the dicts we add to are copied, as deep copying extensions is slow, and
+    # the build only adds our global config to them (which is safe to do twice).
+    kwargs = dict(options)
+
+    kwargs['cmdclass'] = dict(options.get('cmdclass') or {})
+    kwargs['options'] = dict((command, dict(command_options)) for command,
+                        command_options in (options.get('options') or {}).items())
 
     kwargs.setdefault('distclass', Distribution)
-    kwargs.setdefault('cmdclass', {})
 
+    kwargs['cmdclass'].setdefault('build_headerize', build_headerize)
     kwargs['cmdclass'].setdefault('build_shared', build_shared)
     kwargs['cmdclass'].setdefault('build_ext', build_ext)
     kwargs['cmdclass'].setdefault('build_native', build_native)
-    kwargs['cmdclass'].setdefault('build', build)
-    kwargs['cmdclass'].setdefault('build_exe', build_exe)
     kwargs['cmdclass'].setdefault('clean', clean)
 
     # avoid trying to iterate over Nones where we expect these attrs to be lists
     kwargs.setdefault('ext_modules', [])
     kwargs.setdefault('shared_libs', [])
     kwargs.setdefault('native_exes', [])
-
-    kwargs.setdefault('options', {})
+    kwargs.setdefault('header_pairs', [])
 
     kwargs['options'].setdefault('build_ext', {}) # build exts in code directory
     kwargs['options']['build_ext'].setdefault('inplace', True)
@@ -440,7 +1102,21 @@ def setup(**options):
         os.environ['CC' ] = 'clang'
         os.environ['CXX'] = 'clang++'
 
+    # only use cx_Freeze when freezing, so the more common commands start faster
+    if _needs_freeze(kwargs.get('script_args', sys.argv[1:])):
+        import cx_Freeze
+
+        freeze_build = type('build', (build, cx_Freeze.build), {}) # build + build_exe
+
+        kwargs['cmdclass'].setdefault('build', freeze_build)
+        kwargs['cmdclass'].setdefault('build_exe', cx_Freeze.build_exe)
+
+        setup_function = cx_Freeze.setup
+    else:
+        kwargs['cmdclass'].setdefault('build', build)
+        setup_function = distutils.core.setup
+
     start_time = time.time( )
-    cx_Freeze.setup(**kwargs)
+    setup_function(**kwargs)
 
     print("Completed in", time.time() - start_time, "seconds.")